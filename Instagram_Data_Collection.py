@@ -1,7 +1,8 @@
 # Instagram_Data_Collection.py
 # ------------------------------------------------------------
 # Scrapes recent Instagram posts for one or more usernames and
-# writes a single-row CSV summary per account with:
+# writes one CSV summary row per account (all_profiles_summary.csv, override
+# with IG_SUMMARY_CSV) with:
 # - avg likes/comments
 # - view-adjusted ER (for posts with views, e.g., Reels/Video)
 # - posts/week
@@ -24,16 +25,34 @@
 #   $env:IG_USERNAME="your_instagram_username"
 #   $env:IG_PASSWORD="your_instagram_password"
 #   python Instagram_Data_Collection.py all.american.eng englishwiththisguy eslkate
+#
+# Usernames are processed in parallel (IG_PARALLEL workers, default 3) with at
+# most IG_API_CONCURRENCY (default 2) Instagram API calls in flight at once.
+#
+# Profile identities (user id, name, bio, follower counts) are cached for 24h in
+# ig_identity_cache.json next to the session file; pass --no-cache to refetch.
+# Within that window the analyzed posts are cached too, and later runs only
+# page through posts newer than the last one seen.
+# Pass --per-user-csv to also write the old <username>_summary.csv files.
 # ------------------------------------------------------------
 
 import os
 import sys
 import re
 import csv
+import json
+import math
 import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from bisect import bisect_right
 from datetime import datetime
-from typing import List, Dict, Optional, Tuple
-from collections import defaultdict
+from functools import lru_cache
+from typing import List, Dict, Optional, Sequence, Tuple
+from collections import Counter, defaultdict
+from operator import mul
 
 # Console encoding fix for Windows (avoid UnicodeEncodeError on cp1250)
 if os.name == "nt":
@@ -44,7 +63,15 @@ if os.name == "nt":
 
 # pip install instagrapi==2.1.5
 from instagrapi import Client
-from instagrapi.exceptions import ClientForbiddenError
+from instagrapi.exceptions import (
+    BadCredentials,
+    ChallengeRequired,
+    ClientForbiddenError,
+    LoginRequired,
+    PleaseWaitFewMinutes,
+    ReloginAttemptExceeded,
+)
+from requests.adapters import HTTPAdapter  # installed with instagrapi
 
 # ---- HOTFIX: tolerate extract_user_gql signature mismatch in some builds (harmless if not needed) ----
 try:
@@ -63,55 +90,88 @@ except Exception:
 POSTS_TO_FETCH = 25               # last N posts to analyze
 MIN_HASHTAG_OCCURRENCES = 2       # for hashtag efficiency stats
 SESSION_FILE = os.getenv("IG_SESSION_FILE", "ig_session.json")
+IDENTITY_CACHE_FILE = os.getenv(
+    "IG_IDENTITY_CACHE_FILE",
+    os.path.join(os.path.dirname(SESSION_FILE), "ig_identity_cache.json"),
+)
+IDENTITY_CACHE_TTL = 24 * 3600    # seconds before a cached profile identity is refetched
+SUMMARY_CSV = os.getenv("IG_SUMMARY_CSV", "all_profiles_summary.csv")
+PARALLEL_WORKERS = int(os.getenv("IG_PARALLEL", "3"))           # usernames scraped concurrently
+API_CONCURRENCY = int(os.getenv("IG_API_CONCURRENCY", "2"))     # max in-flight IG API calls
 # --------------------------------
 
 
 # ---------- Utilities / parsing ----------
+_HASHTAG_RE = re.compile(r"#\w+")
+
+
 def extract_hashtags(text: str) -> List[str]:
-    return re.findall(r"#\w+", text or "")
-
-
-def guess_theme(hashtags: List[str], caption: str) -> str:
-    blob = (" ".join(hashtags) + " " + (caption or "")).lower()
-    themes = [
-        ("grammar",         ["grammar", "grammartips", "pasttense", "presentperfect", "articles", "tenses"]),
-        ("vocabulary",      ["vocabulary", "vocab", "wordoftheday", "phrases", "idioms", "phrasalverbs"]),
-        ("pronunciation",   ["pronunciation", "accent", "phonetics", "ipa", "sounds"]),
-        ("exam/test prep",  ["ielts", "toefl", "toeic", "cambridge", "pte"]),
-        ("slang/culture",   ["slang", "culture", "britishvsamerican", "usvsuk"]),
-        ("business english",["businessenglish", "interview", "resume", "cv", "email"]),
-        ("study tips",      ["study", "tips", "learnenglish", "englishlearning"]),
-    ]
-    for label, kws in themes:
-        if any(kw in blob for kw in kws):
+    return _HASHTAG_RE.findall(text) if text else []
+
+
+# (label, keywords) in priority order; caption words must match a keyword exactly,
+# hashtags match if they contain one (see guess_theme)
+_THEMES = (
+    ("grammar",         frozenset({"grammar", "grammartips", "pasttense", "presentperfect", "articles", "tenses"})),
+    ("vocabulary",      frozenset({"vocabulary", "vocab", "wordoftheday", "phrases", "idioms", "phrasalverbs"})),
+    ("pronunciation",   frozenset({"pronunciation", "accent", "phonetics", "ipa", "sounds"})),
+    ("exam/test prep",  frozenset({"ielts", "toefl", "toeic", "cambridge", "pte"})),
+    ("slang/culture",   frozenset({"slang", "culture", "britishvsamerican", "usvsuk"})),
+    ("business english",frozenset({"businessenglish", "interview", "resume", "cv", "email"})),
+    ("study tips",      frozenset({"study", "tips", "learnenglish", "englishlearning"})),
+)
+
+_COUNTRIES = [
+    ("United States",  ["usa", "us", "america", "american"]),
+    ("United Kingdom", ["uk", "united kingdom", "british", "england"]),
+    ("Canada",         ["canada", "canadian"]),
+    ("Australia",      ["australia", "aussie", "australian"]),
+    ("India",          ["india", "indian"]),
+    ("Poland",         ["poland", "polish"]),
+    ("France",         ["france", "french"]),
+    ("Germany",        ["germany", "german"]),
+    ("Spain",          ["spain", "spanish"]),
+    ("Italy",          ["italy", "italian"]),
+    ("Brazil",         ["brazil", "brazilian"]),
+    ("Mexico",         ["mexico", "mexican"]),
+    ("China",          ["china", "chinese"]),
+    ("Japan",          ["japan", "japanese"]),
+    ("Korea",          ["korea", "korean"]),
+    ("Turkey",         ["turkey", "turkish"]),
+]
+
+
+def _compile_keyword_table(table) -> List[Tuple[str, re.Pattern]]:
+    # One whole-word alternation per label ("us" must not hit "business");
+    # order is kept so earlier labels still win.
+    return [(label, re.compile(r"\b(?:" + "|".join(map(re.escape, kws)) + r")\b")) for label, kws in table]
+
+
+_COUNTRY_PATTERNS = _compile_keyword_table(_COUNTRIES)
+
+_WORD_RE = re.compile(r"\w+")
+
+
+@lru_cache(maxsize=512)
+def guess_theme(hashtags: Tuple[str, ...], caption: str) -> str:
+    # hashtags must be a tuple so the call is hashable for the cache.
+    # Caption words match keywords exactly; hashtags are usually compounds
+    # (#englishgrammar, #ieltspreparation), so keywords may appear inside them.
+    words = set(_WORD_RE.findall((caption or "").lower()))
+    tags = {h.lstrip("#").lower() for h in hashtags}
+    for label, kws in _THEMES:
+        if not words.isdisjoint(kws) or any(kw in tag for tag in tags for kw in kws):
             return label
     return "general english"
 
 
+@lru_cache(maxsize=256)
 def guess_country_from_bio(bio: str) -> str:
     if not bio:
         return "Unknown"
     bio_low = bio.lower()
-    mapping = {
-        "United States": ["usa", "us", "america", "american"],
-        "United Kingdom": ["uk", "united kingdom", "british", "england"],
-        "Canada": ["canada", "canadian"],
-        "Australia": ["australia", "aussie", "australian"],
-        "India": ["india", "indian"],
-        "Poland": ["poland", "polish"],
-        "France": ["france", "french"],
-        "Germany": ["germany", "german"],
-        "Spain": ["spain", "spanish"],
-        "Italy": ["italy", "italian"],
-        "Brazil": ["brazil", "brazilian"],
-        "Mexico": ["mexico", "mexican"],
-        "China": ["china", "chinese"],
-        "Japan": ["japan", "japanese"],
-        "Korea": ["korea", "korean"],
-        "Turkey": ["turkey", "turkish"],
-    }
-    for country, kws in mapping.items():
-        if any(kw in bio_low for kw in kws):
+    for country, pat in _COUNTRY_PATTERNS:
+        if pat.search(bio_low):
             return country
     return "Unknown"
 
@@ -120,56 +180,194 @@ def posts_per_week(timestamps: List[datetime]) -> Optional[float]:
     ts = [t for t in timestamps if isinstance(t, datetime)]
     if len(ts) < 2:
         return None
-    ts.sort()
-    days = (ts[-1] - ts[0]).days or 1
-    return len(ts) / (days / 7.0) if days > 0 else None
+    days = (max(ts) - min(ts)).days or 1
+    return len(ts) / (days / 7.0)
+
 
+def _mean(vals: Sequence[float]) -> float:
+    # Float mean via fsum: accurate like statistics.mean, without its Fraction arithmetic
+    return math.fsum(vals) / len(vals) if vals else 0.0
 
-def pearson_r(xs: List[float], ys: List[float]) -> Optional[float]:
-    if len(xs) != len(ys) or len(xs) < 2:
+
+def pearson_r(xs: Sequence[float], ys: Sequence[float]) -> Optional[float]:
+    n = len(xs)
+    if n != len(ys) or n < 2:
         return None
-    mean_x = sum(xs) / len(xs)
-    mean_y = sum(ys) / len(ys)
-    num = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys))
-    den_x = (sum((x - mean_x) ** 2 for x in xs)) ** 0.5
-    den_y = (sum((y - mean_y) ** 2 for y in ys)) ** 0.5
+    # Center once, then reduce with C-level map/fsum instead of generator loops
+    mean_x = math.fsum(xs) / n
+    mean_y = math.fsum(ys) / n
+    xc = [x - mean_x for x in xs]
+    yc = [y - mean_y for y in ys]
+    num = math.fsum(map(mul, xc, yc))
+    den_x = math.sqrt(math.fsum(map(mul, xc, xc)))
+    den_y = math.sqrt(math.fsum(map(mul, yc, yc)))
     if den_x == 0 or den_y == 0:
         return None
     return num / (den_x * den_y)
 
 
 # ---------- Instagram Client ----------
-def ig_login() -> Client:
+def _enable_connection_pooling(cl: Client, pool_size: int = 16):
+    """
+    Mount larger keep-alive pools on instagrapi's requests sessions so repeated
+    calls reuse TCP/TLS connections. Keeps whatever retry policy instagrapi set.
+    """
+    for session in (getattr(cl, "private", None), getattr(cl, "public", None)):
+        if session is None:
+            continue
+        retries = session.get_adapter("https://").max_retries
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+
+def ig_login(settings: Optional[Dict] = None) -> Client:
+    """
+    Log in with IG_USERNAME/IG_PASSWORD. Passing settings (another client's
+    get_settings()) reuses that already-authorized session without a new login.
+    """
     user = os.getenv("IG_USERNAME")
     pwd = os.getenv("IG_PASSWORD")
     if not user or not pwd:
         raise RuntimeError("Set IG_USERNAME and IG_PASSWORD environment variables")
     cl = Client()
+    _enable_connection_pooling(cl)
+    if settings is not None:
+        cl.set_settings(settings)
     # Reuse session if possible (reduces 2FA prompts)
-    if os.path.exists(SESSION_FILE):
+    elif os.path.exists(SESSION_FILE):
         try:
             cl.load_settings(SESSION_FILE)
         except Exception:
             pass
     cl.login(user, pwd)
+    if settings is None:
+        try:
+            cl.dump_settings(SESSION_FILE)
+        except Exception:
+            pass
+    return cl
+
+
+# Errors that mean the whole session is unusable, so later usernames would fail too
+_SESSION_ERRORS = (BadCredentials, ChallengeRequired, LoginRequired, PleaseWaitFewMinutes, ReloginAttemptExceeded)
+# Never swallowed by the media fetchers: a dead session must not look like "no posts"
+_AUTH_ERRORS = (ClientForbiddenError,) + _SESSION_ERRORS
+
+_API_SLOTS = threading.BoundedSemaphore(max(1, API_CONCURRENCY))
+
+
+def _api(fn, *args, **kwargs):
+    # Each Instagram call takes a slot only while it runs, so workers overlap
+    # their API calls with other workers' parsing/analysis
+    with _API_SLOTS:
+        return fn(*args, **kwargs)
+
+
+# instagrapi keeps per-request state (last_json, headers) on the Client,
+# so each worker thread gets its own one built from the shared session.
+_worker = threading.local()
+
+
+def _worker_client(settings: Dict) -> Client:
+    cl = getattr(_worker, "client", None)
+    if cl is None:
+        # login() is a no-op for an authorized session, but if it has to hit
+        # Instagram it counts against the same API cap as every other call
+        cl = _api(ig_login, settings)
+        _worker.client = cl
+    return cl
+
+
+def _with_relogin(cl: Client, fn, *args, **kwargs):
+    # Run fn; on ClientForbiddenError re-login once and retry
+    try:
+        return fn(*args, **kwargs)
+    except ClientForbiddenError:
+        _api(cl.relogin)
+        return fn(*args, **kwargs)
+
+
+# ---------- Identity cache ----------
+def _load_identity_cache() -> Dict:
+    if not os.path.exists(IDENTITY_CACHE_FILE):
+        return {}
     try:
-        cl.dump_settings(SESSION_FILE)
+        with open(IDENTITY_CACHE_FILE, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+        return cache if isinstance(cache, dict) else {}
+    except Exception:
+        return {}
+
+
+def _save_identity_cache(cache: Dict):
+    try:
+        with open(IDENTITY_CACHE_FILE, "w", encoding="utf-8") as f:
+            json.dump(cache, f, indent=2)
     except Exception:
         pass
-    return cl
+
+
+def _cached_posts(entry: Dict) -> Tuple[List[Dict], Optional[datetime]]:
+    """
+    Post dicts stored by an earlier full fetch -> (posts, newest taken_at).
+    Returns ([], None) once the full fetch is older than IDENTITY_CACHE_TTL,
+    so like/comment counts on older posts don't go stale indefinitely.
+    """
+    if not entry.get("posts") or time.time() - entry.get("posts_fetched_at", 0) >= IDENTITY_CACHE_TTL:
+        return [], None
+    try:
+        posts = []
+        for d in entry["posts"]:
+            p = dict(d)
+            p["timestamp"] = datetime.fromisoformat(p["timestamp"]) if p.get("timestamp") else None
+            posts.append(p)
+        last_taken_at = datetime.fromisoformat(entry["last_taken_at"])
+    except (KeyError, TypeError, ValueError):
+        return [], None
+    return posts, last_taken_at
+
+
+def _store_posts(cache: Dict, username: str, posts: List[Dict], full_fetch: bool):
+    entry = cache.setdefault(username.lower(), {})
+    entry["posts"] = [
+        dict(p, timestamp=p["timestamp"].isoformat() if isinstance(p["timestamp"], datetime) else None)
+        for p in posts
+    ]
+    stamps = [p["timestamp"] for p in posts if isinstance(p["timestamp"], datetime)]
+    entry["last_taken_at"] = max(stamps).isoformat() if stamps else None
+    if full_fetch:
+        entry["posts_fetched_at"] = time.time()
 
 
 # ---------- Scraping (private-only) ----------
-def get_profile_identity(cl: Client, username: str):
+def get_profile_identity(cl: Client, username: str, cache: Optional[Dict] = None, refresh: bool = False):
     """
     Private-only flow to avoid flaky web/GraphQL calls.
+    If a cache dict is given, a fresh entry (< IDENTITY_CACHE_TTL) skips both
+    API calls; refresh=True ignores the entry but still stores the new result.
     """
-    user_pk = cl.user_id_from_username(username)  # private endpoint
-    info = cl.user_info(user_pk)                  # private endpoint
+    key = username.lower()
+    entry = cache.get(key) if cache is not None and not refresh else None
+    if entry and time.time() - entry.get("fetched_at", 0) < IDENTITY_CACHE_TTL:
+        return entry["display_name"], entry["bio"], entry["followers"], entry["following"], entry["user_pk"]
+
+    user_pk = _api(cl.user_id_from_username, username)  # private endpoint
+    info = _api(cl.user_info, user_pk)                  # private endpoint
     display_name = info.full_name or username
     bio_text     = info.biography or ""
     followers    = info.follower_count or 0
     following    = info.following_count or 0
+    if cache is not None:
+        # update in place so cached posts stored alongside are kept
+        cache.setdefault(key, {}).update({
+            "user_pk": user_pk,
+            "display_name": display_name,
+            "bio": bio_text,
+            "followers": followers,
+            "following": following,
+            "fetched_at": time.time(),
+        })
     return display_name, bio_text, followers, following, user_pk
 
 
@@ -180,16 +378,20 @@ def collect_recent_medias(cl: Client, user_pk: int, limit: int):
     """
     # 1) private mobile API
     try:
-        medias = cl.user_medias_v1(user_pk, amount=limit)
+        medias = _api(cl.user_medias_v1, user_pk, amount=limit)
         if medias:
             return medias[:limit]
+    except _AUTH_ERRORS:
+        raise
     except Exception:
         pass
     # 2) generic (often private under the hood)
     try:
-        medias = cl.user_medias(user_pk, amount=limit)
+        medias = _api(cl.user_medias, user_pk, amount=limit)
         if medias:
             return medias[:limit]
+    except _AUTH_ERRORS:
+        raise
     except Exception:
         pass
     # 3) (disabled) public GraphQL fallback – uncomment if you really want it
@@ -202,6 +404,56 @@ def collect_recent_medias(cl: Client, user_pk: int, limit: int):
     return []
 
 
+def collect_new_medias(cl: Client, user_pk: int, since: datetime, limit: int, page_size: int = 12):
+    """
+    Page through the private feed (newest first) keeping only medias taken after
+    `since`. Stops once a page ends on an older post -- pinned posts can be older
+    but sit at the top of the first page.
+
+    Returns None if paging fails, so the caller can fall back to a full fetch.
+    instagrapi swallows most request errors and returns ([], None); the feed
+    always still holds the older cached posts, so an empty first page with no
+    cursor is treated as a failure rather than "nothing new".
+    """
+    medias = []
+    cursor = ""
+    try:
+        while len(medias) < limit:
+            first_page = cursor == ""
+            page, cursor = _api(cl.user_medias_paginated_v1, user_pk, amount=page_size, end_cursor=cursor)
+            if first_page and not page and not cursor:
+                return None
+            medias.extend(m for m in page if m.taken_at > since)
+            if not page or not cursor or page[-1].taken_at <= since:
+                break
+    except _AUTH_ERRORS:
+        raise
+    except Exception:
+        return None
+    return medias[:limit]
+
+
+def _fetch_medias(cl: Client, user_pk: int, cached_posts: List[Dict], last_taken_at: Optional[datetime]):
+    """
+    -> (medias, cached_posts still to merge, full_fetch). With cached posts only
+    newer medias are paged in; otherwise (or if paging fails) do a full fetch.
+    """
+    if cached_posts:
+        medias = collect_new_medias(cl, user_pk, last_taken_at, POSTS_TO_FETCH)
+        if medias is not None:
+            return medias, cached_posts, False
+    return collect_recent_medias(cl, user_pk, POSTS_TO_FETCH), [], True
+
+
+_NL_TRANS = str.maketrans({"\n": " ", "\r": " ", "\t": " "})
+
+
+def _caption_display(caption: str) -> str:
+    # One-line, 60-char preview for the per-post snapshot
+    cap = (caption or "").translate(_NL_TRANS)
+    return cap[:57] + "..." if len(cap) > 60 else cap
+
+
 def _media_type_name(media_type: int) -> str:
     # 1=Photo, 2=Video, 8=Album (per instagrapi)
     return {1: "Photo", 2: "Video", 8: "Album"}.get(media_type, str(media_type))
@@ -211,26 +463,29 @@ def scrape_media(m) -> Dict:
     """
     Convert instagrapi Media -> our post dict.
     """
-    views = getattr(m, "view_count", None) or getattr(m, "play_count", None) or 0
-    likes = getattr(m, "like_count", 0) or 0
-    comments = getattr(m, "comment_count", 0) or 0
+    # Pydantic models keep field values in __dict__: read that snapshot once
+    # instead of a getattr per field (model_dump() would also copy nested models)
+    d = vars(m)
+    views = d.get("view_count") or d.get("play_count") or 0
+    likes = d.get("like_count") or 0
+    comments = d.get("comment_count") or 0
 
     # IG doesn't expose shares/saves publicly
     shares = 0
     saves = 0
 
-    caption = (getattr(m, "caption_text", "") or "").strip()
+    caption = (d.get("caption_text") or "").strip()
     hashtags = extract_hashtags(caption)
     caption_len = len(caption)
-    ts = getattr(m, "taken_at", None)
+    ts = d.get("taken_at")
 
     er_view = None
     if views and views > 0:
         er_view = (likes + comments) / views
 
-    code = getattr(m, "code", None)
+    code = d.get("code")
     url = f"https://www.instagram.com/p/{code}/" if code else ""
-    theme = guess_theme(hashtags, caption)
+    theme = guess_theme(tuple(hashtags), caption)
 
     return {
         "url": url,
@@ -241,89 +496,103 @@ def scrape_media(m) -> Dict:
         "saves": saves,
         "er_view": er_view,
         "caption": caption,
+        "caption_display": _caption_display(caption),
         "caption_len": caption_len,
         "hashtags": hashtags,
         "timestamp": ts,
         "theme": theme,
-        "media_type": _media_type_name(getattr(m, "media_type", 0)),
+        "media_type": _media_type_name(d.get("media_type", 0)),
     }
 
 
 # ---------- Analysis helpers ----------
-def hashtag_efficiency(posts: List[Dict], min_occurrences=2):
-    ers = [p["er_view"] for p in posts if p.get("er_view") is not None]
-    overall = statistics.mean(ers) if ers else 0.0
-    bucket = defaultdict(list)
+def analyze_posts(posts: List[Dict]):
+    """
+    Single pass over posts -> (ers, tag_bucket, hour_bucket, weekday_bucket, cat_bucket).
+    Only posts with a view-adjusted ER are counted. Every bucket is a (sums, counts)
+    pair: dicts keyed by hashtag / theme, fixed-size lists indexed by hour 0-23 /
+    weekday 0=Mon..6.
+    """
+    ers = []
+    tag_sums, tag_counts = defaultdict(float), defaultdict(int)
+    cat_sums, cat_counts = defaultdict(float), defaultdict(int)
+    hour_sums, hour_counts = [0.0] * 24, [0] * 24
+    weekday_sums, weekday_counts = [0.0] * 7, [0] * 7
     for p in posts:
-        if p.get("er_view") is None:
+        er = p.get("er_view")
+        if er is None:
             continue
-        for h in set(p.get("hashtags", [])):
-            bucket[h.lower()].append(p["er_view"])
+        ers.append(er)
+        for h in {t.lower() for t in p.get("hashtags", [])}:
+            tag_sums[h] += er
+            tag_counts[h] += 1
+        cat = p.get("theme", "general english")
+        cat_sums[cat] += er
+        cat_counts[cat] += 1
+        ts = p.get("timestamp")
+        if isinstance(ts, datetime):
+            hour_sums[ts.hour] += er
+            hour_counts[ts.hour] += 1
+            wd = ts.weekday()  # 0=Mon
+            weekday_sums[wd] += er
+            weekday_counts[wd] += 1
+    return (ers, (tag_sums, tag_counts), (hour_sums, hour_counts),
+            (weekday_sums, weekday_counts), (cat_sums, cat_counts))
+
+
+def _lift_rows(bucket: Tuple[Dict, Dict], overall: float, min_occurrences: int):
+    sums, counts = bucket
     rows = []
-    for h, vals in bucket.items():
-        if len(vals) >= min_occurrences:
-            avg = statistics.mean(vals)
+    for key, n in counts.items():
+        if n >= min_occurrences:
+            avg = sums[key] / n
             lift = avg - overall
-            rows.append((h, len(vals), avg, lift))
+            rows.append((key, n, avg, lift))
     rows.sort(key=lambda x: x[3], reverse=True)
-    return overall, rows
+    return rows
 
 
-def posting_window_performance(posts: List[Dict]):
-    hour_bucket = defaultdict(list)
-    weekday_bucket = defaultdict(list)
-    for p in posts:
-        if p.get("er_view") is None or not isinstance(p.get("timestamp"), datetime):
-            continue
-        ts = p["timestamp"]
-        hour_bucket[ts.hour].append(p["er_view"])
-        weekday_bucket[ts.weekday()].append(p["er_view"])  # 0=Mon
+def hashtag_efficiency(tag_bucket: Tuple[Dict, Dict], overall: float, min_occurrences=2):
+    return _lift_rows(tag_bucket, overall, min_occurrences)
+
 
+def posting_window_performance(hour_bucket: Tuple[List[float], List[int]],
+                               weekday_bucket: Tuple[List[float], List[int]]):
     def top_avg(bucket, topn=3):
-        avgs = []
-        for k, vals in bucket.items():
-            if len(vals) >= 2:
-                avgs.append((k, statistics.mean(vals), len(vals)))
+        sums, counts = bucket
+        avgs = [(k, sums[k] / n, n) for k, n in enumerate(counts) if n >= 2]
         avgs.sort(key=lambda x: x[1], reverse=True)
         return avgs[:topn]
 
     return top_avg(hour_bucket), top_avg(weekday_bucket)
 
 
+# Lower edges of caption-length buckets 2..n (bucket 1 starts at 0)
+CAPTION_LEN_EDGES = [21, 41, 61, 81, 121]
+CAPTION_LEN_LABELS = ["0-20", "21-40", "41-60", "61-80", "81-120", "121+"]
+
+
 def caption_length_vs_er(posts: List[Dict]):
     pts = [(p["caption_len"], p["er_view"]) for p in posts if p.get("er_view") is not None]
     if not pts:
         return None, {}
     xs, ys = zip(*pts)
-    r = pearson_r(list(xs), list(ys))
-    bins = [(0, 20), (21, 40), (41, 60), (61, 80), (81, 120), (121, 9999)]
-    labels = ["0-20", "21-40", "41-60", "61-80", "81-120", "121+"]
-    bucket = {label: [] for label in labels}
+    r = pearson_r(xs, ys)
+    sums = [0.0] * len(CAPTION_LEN_LABELS)
+    counts = [0] * len(CAPTION_LEN_LABELS)
     for length, er in pts:
-        for (lo, hi), lab in zip(bins, labels):
-            if lo <= length <= hi:
-                bucket[lab].append(er)
-                break
-    bucket_avg = {lab: (statistics.mean(v) if v else 0.0, len(v)) for lab, v in bucket.items()}
+        i = bisect_right(CAPTION_LEN_EDGES, length)
+        sums[i] += er
+        counts[i] += 1
+    bucket_avg = {
+        lab: (sums[i] / counts[i] if counts[i] else 0.0, counts[i])
+        for i, lab in enumerate(CAPTION_LEN_LABELS)
+    }
     return r, bucket_avg
 
 
-def content_category_lift(posts: List[Dict]):
-    ers = [p["er_view"] for p in posts if p.get("er_view") is not None]
-    overall = statistics.mean(ers) if ers else 0.0
-    cat_bucket = defaultdict(list)
-    for p in posts:
-        if p.get("er_view") is None:
-            continue
-        cat_bucket[p.get("theme", "general english")].append(p["er_view"])
-    rows = []
-    for cat, vals in cat_bucket.items():
-        if len(vals) >= 2:
-            avg = statistics.mean(vals)
-            lift = avg - overall
-            rows.append((cat, len(vals), avg, lift))
-    rows.sort(key=lambda x: x[3], reverse=True)
-    return overall, rows
+def content_category_lift(cat_bucket: Tuple[Dict, Dict], overall: float):
+    return _lift_rows(cat_bucket, overall, 2)
 
 
 # ---------- CSV writer ----------
@@ -348,163 +617,230 @@ CSV_COLUMNS = [
 ]
 
 
-def write_profile_summary_csv(username: str, row: Dict):
+@contextmanager
+def open_summary_writer(path: str):
+    """
+    Open the combined summary CSV once per run and write the header;
+    yields a csv.writer that takes rows in CSV_COLUMNS order.
+    """
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        w = csv.writer(f)
+        w.writerow(CSV_COLUMNS)
+        yield w
+
+
+def write_profile_summary_csv(username: str, row: Tuple):
     fname = f"{username}_summary.csv"
     with open(fname, "w", newline="", encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=CSV_COLUMNS)
-        w.writeheader()
+        w = csv.writer(f)
+        w.writerow(CSV_COLUMNS)
         w.writerow(row)
-    print(f"Saved: {fname}")
+    return fname
 
 
 # ---------- Orchestration / output ----------
+def process_username(settings: Dict, username: str, identity_cache: Dict,
+                     refresh: bool = False, per_user_csv: bool = False) -> Tuple[Optional[Tuple], List[str]]:
+    """
+    Scrape + analyze one account -> (CSV row or None, console lines). Runs on a
+    worker thread, so output is buffered for the caller to print and the row is
+    written by the caller's single summary writer.
+    """
+    cl = _worker_client(settings)
+    out = [f"\n===== @{username} (Instagram) ====="]
+
+    # Profile identity with re-login retry
+    display_name, bio, followers, following, user_pk = _with_relogin(
+        cl, get_profile_identity, cl, username, identity_cache, refresh=refresh)
+
+    # Within the cache TTL, only fetch posts newer than the last run and
+    # reuse the stored ones; otherwise do a full fetch. A cached identity
+    # means no call has checked the session yet, so this gets the retry too.
+    cached_posts, last_taken_at = ([], None) if refresh else _cached_posts(identity_cache.get(username.lower(), {}))
+    medias, cached_posts, full_fetch = _with_relogin(
+        cl, _fetch_medias, cl, user_pk, cached_posts, last_taken_at)
+    if not medias and not cached_posts:
+        out.append("No recent posts found or profile is private.")
+        return None, out
+
+    posts = []
+    for i, m in enumerate(medias, 1):
+        try:
+            posts.append(scrape_media(m))
+        except Exception as e:
+            out.append(f"  (skip post {i}: {e})")
+    if cached_posts:
+        new_urls = {p["url"] for p in posts}
+        posts += [p for p in cached_posts if p["url"] not in new_urls]
+        posts = posts[:POSTS_TO_FETCH]
+    _store_posts(identity_cache, username, posts, full_fetch)
+
+    # Aggregates
+    likes_list    = [p["likes"]    for p in posts]
+    comments_list = [p["comments"] for p in posts]
+    shares_list   = [p["shares"]   for p in posts]
+    saves_list    = [p["saves"]    for p in posts]
+    timestamps    = [p["timestamp"] for p in posts if p["timestamp"]]
+
+    avg_likes    = _mean(likes_list)
+    avg_comments = _mean(comments_list)
+    avg_shares   = _mean(shares_list)
+    avg_saves    = _mean(saves_list)
+
+    # View-adjusted ER (only where views exist), plus all per-post buckets in one pass
+    er_vals, tag_bucket, hour_bucket, weekday_bucket, cat_bucket = analyze_posts(posts)
+    er_mean = _mean(er_vals)
+    er_median = statistics.median(er_vals) if er_vals else 0.0  # not in CSV
+
+    # Post frequency
+    freq = posts_per_week(timestamps)
+    post_freq = round(freq, 4) if freq else None
+
+    # Theme majority
+    themes = [p["theme"] for p in posts]
+    content_theme = Counter(themes).most_common(1)[0][0] if themes else "general english"
+
+    # Country/Region guess
+    country = guess_country_from_bio(bio)
+
+    # Unique hashtags
+    all_tags = []
+    for p in posts:
+        all_tags.extend(p["hashtags"])
+    unique_tags = sorted(set(all_tags))
+    hashtags_used_str = ";".join(unique_tags)
+
+    # Hashtag efficiency (top 5)
+    tag_rows = hashtag_efficiency(tag_bucket, er_mean, MIN_HASHTAG_OCCURRENCES)
+    top_tags = [f"{tag}:{lift:+.4f}(n={n})" for tag, n, avg, lift in tag_rows[:5]]
+    tag_eff_str = ";".join(top_tags) if top_tags else ""
+
+    # Posting window performance
+    hour_tops, weekday_tops = posting_window_performance(hour_bucket, weekday_bucket)
+    hours_str = ",".join([f"h{h}@{avg:.4f}(n={n})" for h, avg, n in hour_tops]) if hour_tops else ""
+    wd_map = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+    wdays_str = ",".join([f"{wd_map[d]}@{avg:.4f}(n={n})" for d, avg, n in weekday_tops]) if weekday_tops else ""
+    posting_perf_str = f"hours[{hours_str}]|weekdays[{wdays_str}]"
+
+    # Caption length vs ER
+    r, buckets = caption_length_vs_er(posts)
+    if r is not None:
+        bucket_parts = [f"{lab}:{avg:.4f}(n={n})" for lab, (avg, n) in buckets.items()]
+        caption_vs_er_str = f"r={r:.3f}; " + ";".join(bucket_parts)
+    else:
+        caption_vs_er_str = "r=N/A"
+
+    # Content category lift
+    cat_rows = content_category_lift(cat_bucket, er_mean)
+    top_cats = [f"{cat}:{lift:+.4f}(n={n})" for cat, n, avg, lift in cat_rows[:5]]
+    cat_lift_str = ";".join(top_cats) if top_cats else ""
+
+    # Console summary (ASCII-only to avoid Unicode errors)
+    out.append(f"Followers:              {followers:,}")
+    out.append(f"Following:              {following:,}")
+    out.append(f"Analyzed posts:         {len(posts)}")
+    out.append(f"Avg Likes:              {avg_likes:,.2f}")
+    out.append(f"Avg Comments:           {avg_comments:,.2f}")
+    out.append(f"View-adjusted ER:       mean={er_mean:.4f}, median={er_median:.4f}")
+    out.append(f"Post frequency:         {post_freq if post_freq is not None else 'Unknown'} posts/week")
+    out.append(f"Content type:           Instagram (Post/Reel)")
+    out.append(f"Content theme:          {content_theme}")
+    out.append(f"Avg shares / saves:     {avg_shares:.2f} / {avg_saves:.2f}")
+    out.append(f"Country/Region:         {country}")
+
+    # CSV row (schema-compatible), positional in CSV_COLUMNS order
+    row = (
+        display_name,                                                   # tiktok_profile_name
+        username,                                                       # username
+        len(posts),                                                     # posts_analyzed
+        round(avg_likes, 4),                                            # avg_likes
+        round(avg_comments, 4),                                         # avg_comments
+        round(er_mean, 6),                                              # engagement_rate_view_adj_mean
+        round(post_freq, 4) if post_freq is not None else "",           # post_frequency_per_week
+        "Instagram (Post/Reel)",                                        # content_type
+        content_theme,                                                  # content_theme
+        round(avg_shares, 4) if avg_shares else 0.0,                    # avg_shares
+        round(avg_saves, 4) if avg_saves else 0.0,                      # avg_saves
+        hashtags_used_str,                                              # hashtags_used
+        country,                                                        # country_region
+        tag_eff_str,                                                    # hashtag_efficiency_top
+        posting_perf_str,                                               # posting_window_performance
+        caption_vs_er_str,                                              # caption_length_vs_er
+        cat_lift_str,                                                   # content_category_lift_top
+    )
+
+    if per_user_csv:
+        out.append(f"Saved: {write_profile_summary_csv(username, row)}")
+
+    # Per-post snapshot (ASCII-friendly)
+    out.append("\nPer-post snapshot:")
+    for i, p in enumerate(posts, 1):
+        ts = p["timestamp"].strftime("%Y-%m-%d") if isinstance(p["timestamp"], datetime) else "?"
+        cap = p["caption_display"]
+        er = p["er_view"]
+        er_str = f"{er:.4f}" if er is not None else "NA"
+        out.append(f" {i:02d}. views={p['views']:>7} | likes={p['likes']:>6} | comments={p['comments']:>5} | ER {er_str:>6} | {ts} | {cap}")
+
+    return row, out
+
+
+KNOWN_FLAGS = {"--no-cache", "--per-user-csv"}
+
+
+def _usage_exit():
+    print("Usage: python Instagram_Data_Collection.py [--no-cache] [--per-user-csv] <username1> <username2> ...")
+    print("Or set IG_TARGET_USERNAME env var.")
+    sys.exit(1)
+
+
 def main(args: list):
+    flags = {a for a in args if a.startswith("--")}
+    args = [a for a in args if not a.startswith("--")]
+    unknown = flags - KNOWN_FLAGS
+    if unknown:
+        print(f"Unknown option(s): {', '.join(sorted(unknown))}")
+        _usage_exit()
+    no_cache = "--no-cache" in flags
+    per_user_csv = "--per-user-csv" in flags
     if len(args) >= 1:
         usernames = args
     else:
         env_user = os.getenv("IG_TARGET_USERNAME")
         if not env_user:
-            print("Usage: python Instagram_Data_Collection.py <username1> <username2> ...")
-            print("Or set IG_TARGET_USERNAME env var.")
-            sys.exit(1)
+            _usage_exit()
         usernames = [env_user]
 
     cl = ig_login()
+    settings = cl.get_settings()
+    identity_cache = _load_identity_cache()
 
     try:
-        for username in usernames:
-            print(f"\n===== @{username} (Instagram) =====")
-
-            # Profile identity with re-login retry
-            try:
-                display_name, bio, followers, following, user_pk = get_profile_identity(cl, username)
-            except ClientForbiddenError:
-                cl.relogin()
-                display_name, bio, followers, following, user_pk = get_profile_identity(cl, username)
-
-            medias = collect_recent_medias(cl, user_pk, POSTS_TO_FETCH)
-            if not medias:
-                print("No recent posts found or profile is private.")
-                continue
-
-            posts = []
-            for i, m in enumerate(medias, 1):
+        saved = 0
+        with open_summary_writer(SUMMARY_CSV) as summary, \
+                ThreadPoolExecutor(max_workers=max(1, PARALLEL_WORKERS)) as pool:
+            futures = [
+                pool.submit(process_username, settings, username, identity_cache, no_cache, per_user_csv)
+                for username in usernames
+            ]
+            # Collect in command-line order so console blocks and CSV rows are deterministic
+            for username, fut in zip(usernames, futures):
                 try:
-                    posts.append(scrape_media(m))
+                    row, lines = fut.result()
+                except _SESSION_ERRORS:
+                    for f in futures:
+                        f.cancel()
+                    raise
                 except Exception as e:
-                    print(f"  (skip post {i}: {e})")
-
-            # Aggregates
-            likes_list    = [p["likes"]    for p in posts]
-            comments_list = [p["comments"] for p in posts]
-            shares_list   = [p["shares"]   for p in posts]
-            saves_list    = [p["saves"]    for p in posts]
-            timestamps    = [p["timestamp"] for p in posts if p["timestamp"]]
-
-            avg_likes    = statistics.mean(likes_list) if likes_list else 0.0
-            avg_comments = statistics.mean(comments_list) if comments_list else 0.0
-            avg_shares   = statistics.mean(shares_list) if shares_list else 0.0
-            avg_saves    = statistics.mean(saves_list) if saves_list else 0.0
-
-            # View-adjusted ER (only where views exist)
-            er_vals = [p["er_view"] for p in posts if p.get("er_view") is not None]
-            er_mean = statistics.mean(er_vals) if er_vals else 0.0
-            er_median = statistics.median(er_vals) if er_vals else 0.0  # not in CSV
-
-            # Post frequency
-            freq = posts_per_week(timestamps)
-            post_freq = round(freq, 4) if freq else None
-
-            # Theme majority
-            themes = [p["theme"] for p in posts]
-            try:
-                content_theme = statistics.mode(themes) if themes else "general english"
-            except statistics.StatisticsError:
-                content_theme = "general english"
-
-            # Country/Region guess
-            country = guess_country_from_bio(bio)
-
-            # Unique hashtags
-            all_tags = []
-            for p in posts:
-                all_tags.extend(p["hashtags"])
-            unique_tags = sorted(set(all_tags))
-            hashtags_used_str = ";".join(unique_tags)
-
-            # Hashtag efficiency (top 5)
-            overall_er, tag_rows = hashtag_efficiency(posts, MIN_HASHTAG_OCCURRENCES)
-            top_tags = [f"{tag}:{lift:+.4f}(n={n})" for tag, n, avg, lift in tag_rows[:5]]
-            tag_eff_str = ";".join(top_tags) if top_tags else ""
-
-            # Posting window performance
-            hour_tops, weekday_tops = posting_window_performance(posts)
-            hours_str = ",".join([f"h{h}@{avg:.4f}(n={n})" for h, avg, n in hour_tops]) if hour_tops else ""
-            wd_map = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
-            wdays_str = ",".join([f"{wd_map[d]}@{avg:.4f}(n={n})" for d, avg, n in weekday_tops]) if weekday_tops else ""
-            posting_perf_str = f"hours[{hours_str}]|weekdays[{wdays_str}]"
-
-            # Caption length vs ER
-            r, buckets = caption_length_vs_er(posts)
-            if r is not None:
-                bucket_parts = [f"{lab}:{avg:.4f}(n={n})" for lab, (avg, n) in buckets.items()]
-                caption_vs_er_str = f"r={r:.3f}; " + ";".join(bucket_parts)
-            else:
-                caption_vs_er_str = "r=N/A"
-
-            # Content category lift
-            overall_cat, cat_rows = content_category_lift(posts)
-            top_cats = [f"{cat}:{lift:+.4f}(n={n})" for cat, n, avg, lift in cat_rows[:5]]
-            cat_lift_str = ";".join(top_cats) if top_cats else ""
-
-            # Console summary (ASCII-only to avoid Unicode errors)
-            print(f"Followers:              {followers:,}")
-            print(f"Following:              {following:,}")
-            print(f"Analyzed posts:         {len(posts)}")
-            print(f"Avg Likes:              {avg_likes:,.2f}")
-            print(f"Avg Comments:           {avg_comments:,.2f}")
-            print(f"View-adjusted ER:       mean={er_mean:.4f}, median={er_median:.4f}")
-            print(f"Post frequency:         {post_freq if post_freq is not None else 'Unknown'} posts/week")
-            print(f"Content type:           Instagram (Post/Reel)")
-            print(f"Content theme:          {content_theme}")
-            print(f"Avg shares / saves:     {avg_shares:.2f} / {avg_saves:.2f}")
-            print(f"Country/Region:         {country}")
-
-            # CSV row (schema-compatible)
-            row = {
-                "tiktok_profile_name": display_name,
-                "username": username,
-                "posts_analyzed": len(posts),
-                "avg_likes": round(avg_likes, 4),
-                "avg_comments": round(avg_comments, 4),
-                "engagement_rate_view_adj_mean": round(er_mean, 6),
-                "post_frequency_per_week": round(post_freq, 4) if post_freq is not None else "",
-                "content_type": "Instagram (Post/Reel)",
-                "content_theme": content_theme,
-                "avg_shares": round(avg_shares, 4) if avg_shares else 0.0,
-                "avg_saves": round(avg_saves, 4) if avg_saves else 0.0,
-                "hashtags_used": hashtags_used_str,
-                "country_region": country,
-                "hashtag_efficiency_top": tag_eff_str,
-                "posting_window_performance": posting_perf_str,
-                "caption_length_vs_er": caption_vs_er_str,
-                "content_category_lift_top": cat_lift_str,
-            }
-
-            write_profile_summary_csv(username, row)
-
-            # Per-post snapshot (ASCII-friendly)
-            print("\nPer-post snapshot:")
-            for i, p in enumerate(posts, 1):
-                ts = p["timestamp"].strftime("%Y-%m-%d") if isinstance(p["timestamp"], datetime) else "?"
-                cap = (p["caption"] or "").replace("\n", " ")
-                if len(cap) > 60:
-                    cap = cap[:57] + "..."
-                er = p["er_view"]
-                er_str = f"{er:.4f}" if er is not None else "NA"
-                print(f" {i:02d}. views={p['views']:>7} | likes={p['likes']:>6} | comments={p['comments']:>5} | ER {er_str:>6} | {ts} | {cap}")
+                    print(f"\n@{username}: {e}")
+                    continue
+                print("\n".join(lines))
+                if row is not None:
+                    summary.writerow(row)
+                    saved += 1
+        print(f"\nSaved: {SUMMARY_CSV} ({saved} profile(s))")
 
     finally:
+        _save_identity_cache(identity_cache)
         try:
             cl.logout()
         except Exception: